@@ -0,0 +1,46 @@
+# tests/test_pip_float32.py
+# el cruce corre en float32: ninguna frontera de geocerca se mueve más de 1 m
+# correr con: pytest -q (pytest.ini pone la raíz en sys.path)
+
+import numpy as np
+
+from wialon_core import _PIP_SPECIALIZED, _points_in_polygon, _prepare_zone
+
+M_PER_DEG = 111_000
+
+
+def _dist_to_ring_m(lon: float, lat: float, lons: np.ndarray, lats: np.ndarray) -> float:
+    x1, y1 = np.roll(lons, 1), np.roll(lats, 1)
+    dx, dy = lons - x1, lats - y1
+    t = np.clip(((lon - x1) * dx + (lat - y1) * dy) / (dx * dx + dy * dy), 0.0, 1.0)
+    return float(np.hypot(x1 + t * dx - lon, y1 + t * dy - lat).min()) * M_PER_DEG
+
+
+def test_float32_boundary_shift_below_1m():
+    rng = np.random.default_rng(0)
+    for n in (*_PIP_SPECIALIZED, 7, 30):
+        for _ in range(40):
+            # polígonos estrellados dentro de México (lon ~ -100 es el peor caso de float32)
+            c_lon, c_lat = rng.uniform(-118, -86), rng.uniform(14, 33)
+            ang = np.sort(rng.uniform(0, 2 * np.pi, n))
+            rad = rng.uniform(0.001, 0.05, n)
+            xy = np.column_stack([c_lon + rad * np.cos(ang), c_lat + rad * np.sin(ang)])
+            g = _prepare_zone({"points_xy": xy})
+
+            p_lon = c_lon + rng.uniform(-0.06, 0.06, 2000)
+            p_lat = c_lat + rng.uniform(-0.06, 0.06, 2000)
+            exact = _points_in_polygon(p_lat, p_lon, xy[:, 0].copy(), xy[:, 1].copy())
+            fp32 = g["_pip"](
+                p_lat.astype(np.float32), p_lon.astype(np.float32), g["_lons"], g["_lats"]
+            )
+
+            for k in np.nonzero(exact != fp32)[0]:
+                assert _dist_to_ring_m(p_lon[k], p_lat[k], xy[:, 0], xy[:, 1]) < 1.0
+
+
+def test_prepare_zone_keeps_float64_points():
+    xy = np.asarray([(-99.14, 19.39), (-99.12, 19.39), (-99.12, 19.41)])
+    g = _prepare_zone({"points_xy": xy})
+    assert g["points_xy"].dtype == np.float64
+    assert g["points_xy"].tolist() == xy.tolist()
+    assert g["_lons"].dtype == np.float32 and g["_lons"].flags.c_contiguous
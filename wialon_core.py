@@ -0,0 +1,247 @@
+# wialon_core.py
+# sesión Wialon, cliente HTTP compartido y kernels de geometría
+# (lo usa wialon_geocercas.py; un solo módulo, una sola sesión)
+
+import os
+import time
+import asyncio
+from typing import Optional, Dict, Any, List, Tuple
+
+import httpx
+import orjson
+import numpy as np
+from numba import njit
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+# ------------------------------------------------------------
+# .env (local) / variables de entorno (Render)
+# ------------------------------------------------------------
+load_dotenv()
+
+WIALON_BASE = os.getenv("WIALON_BASE", "https://hst-api.wialon.com/wialon/ajax.html")
+WIALON_TOKEN = os.getenv("WIALON_TOKEN", "")
+
+SESSION_SID: Optional[str] = None
+SESSION_TS: float = 0
+# serializa el login: con requests concurrentes solo uno renueva el sid
+_sid_lock = asyncio.Lock()
+
+# cliente HTTP compartido (HTTP/2 + keep-alive); se abre/cierra en lifespan
+_client: Optional[httpx.AsyncClient] = None
+
+
+def open_client() -> None:
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=40,
+        headers={"Accept-Encoding": "gzip"},
+        # con transport explícito, http2/limits van en el transport
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        ),
+    )
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# ------------------------------------------------------------
+# helpers de sesión
+# ------------------------------------------------------------
+def _dumps(p: Any) -> str:
+    return orjson.dumps(p).decode()
+
+
+def _loads(b: bytes) -> Any:
+    return orjson.loads(b)
+
+
+async def _login_with_token(token: str) -> str:
+    r = await _client.post(
+        WIALON_BASE,
+        params={"svc": "token/login"},
+        data={"params": _dumps({"token": token, "fl": 8})},
+        timeout=20,
+    )
+    if r.is_error:
+        raise HTTPException(status_code=502, detail=f"token/login HTTP {r.status_code}")
+    data = _loads(r.content)
+    sid = data.get("eid") or data.get("sid")
+    if not sid:
+        raise HTTPException(status_code=400, detail=f"token/login falló: {data}")
+    return sid
+
+
+async def _ensure_sid() -> str:
+    global SESSION_SID, SESSION_TS
+    if not WIALON_TOKEN:
+        raise HTTPException(status_code=400, detail="Falta WIALON_TOKEN en entorno")
+
+    # usa cache 4 minutos
+    if SESSION_SID and (time.time() - SESSION_TS) < 240:
+        return SESSION_SID
+
+    async with _sid_lock:
+        # otro request pudo haberlo renovado mientras esperábamos
+        if SESSION_SID and (time.time() - SESSION_TS) < 240:
+            return SESSION_SID
+        try:
+            sid = await _login_with_token(WIALON_TOKEN)
+            SESSION_SID = sid
+            SESSION_TS = time.time()
+            return sid
+        except HTTPException as e:
+            # si el token en realidad ya es un sid
+            if "WRONG_PARAMS" in str(e.detail) or "invalid token" in str(e.detail).lower():
+                SESSION_SID = WIALON_TOKEN
+                SESSION_TS = time.time()
+                return SESSION_SID
+            raise
+
+
+async def wialon_call(svc: str, params: Dict[str, Any]) -> Any:
+    sid = await _ensure_sid()
+    # POST form-encoded: los batch no caben en la URL
+    body = {"params": _dumps(params)}
+    r = await _client.post(WIALON_BASE, params={"svc": svc, "sid": sid}, data=body)
+    if r.is_error:
+        raise HTTPException(status_code=502, detail=f"Wialon HTTP {r.status_code}: {r.text}")
+
+    data = _loads(r.content)
+    # errores de sesión → reintenta una vez
+    if isinstance(data, dict) and data.get("error") in (1, 2, 3, 4, 5, 8):
+        global SESSION_SID
+        # invalida solo si nadie lo renovó ya (evita logins en cascada)
+        if SESSION_SID == sid:
+            SESSION_SID = None
+        sid = await _ensure_sid()
+        r2 = await _client.post(WIALON_BASE, params={"svc": svc, "sid": sid}, data=body)
+        if r2.is_error:
+            raise HTTPException(status_code=502, detail=f"Wialon HTTP {r2.status_code}: {r2.text}")
+        return _loads(r2.content)
+    return data
+
+
+async def wialon_batch(calls: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+    """Varias llamadas en un solo round-trip (core/batch); respuestas en el mismo orden."""
+    data = await wialon_call(
+        "core/batch",
+        {"params": [{"svc": svc, "params": params} for svc, params in calls], "flags": 0},
+    )
+    if not isinstance(data, list) or len(data) != len(calls):
+        raise HTTPException(status_code=502, detail=f"core/batch respuesta inesperada: {data}")
+    for (svc, _), res in zip(calls, data):
+        if isinstance(res, dict) and "error" in res:
+            raise HTTPException(status_code=502, detail=f"{svc} (batch) error {res['error']}")
+    return data
+
+
+# ------------------------------------------------------------
+# utilidades de geometría
+# ------------------------------------------------------------
+def _prepare_zone(g: Dict[str, Any]) -> Dict[str, Any]:
+    """Precalcula lo que usa el cruce: columnas lon/lat del anillo, bbox y radio²."""
+    xy = g.get("points_xy")
+    if xy is not None and len(xy) >= 3:
+        # copias contiguas en float32 (~1 m) solo para los kernels;
+        # points_xy se queda en float64 para la respuesta
+        g["_lons"] = np.ascontiguousarray(xy[:, 0], dtype=np.float32)
+        g["_lats"] = np.ascontiguousarray(xy[:, 1], dtype=np.float32)
+        g["_bbox"] = (
+            float(g["_lats"].min()),
+            float(g["_lats"].max()),
+            float(g["_lons"].min()),
+            float(g["_lons"].max()),
+        )
+        g["_pip"] = _PIP_SPECIALIZED.get(len(xy), _points_in_polygon)
+    if g.get("center") and g.get("radius"):
+        # el cruce compara distancias al cuadrado: sin sqrt
+        g["_r2"] = g["radius"] * g["radius"]
+    return g
+
+
+@njit(cache=True, fastmath=True)
+def _point_in_polygon(lat: float, lon: float, lons: np.ndarray, lats: np.ndarray) -> bool:
+    inside = False
+    n = lons.shape[0]
+    if n < 3:
+        return False
+    # Franklin PNPOLY: j arranca en el último vértice y el (xi, yi) de cada
+    # vuelta se reusa como (xj, yj) de la siguiente (una lectura por vértice)
+    xj, yj = lons[n - 1], lats[n - 1]
+    for i in range(n):
+        xi, yi = lons[i], lats[i]
+        # si las y's quedan a distinto lado de lat, yj - yi != 0
+        if (yi > lat) != (yj > lat):
+            if lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+                inside = not inside
+        xj, yj = xi, yi
+    return inside
+
+
+@njit(cache=True, fastmath=True)
+def _points_in_polygon(
+    lats_p: np.ndarray, lons_p: np.ndarray, lons: np.ndarray, lats: np.ndarray
+) -> np.ndarray:
+    out = np.zeros(lats_p.shape[0], dtype=np.bool_)
+    for k in range(lats_p.shape[0]):
+        out[k] = _point_in_polygon(lats_p[k], lons_p[k], lons, lats)
+    return out
+
+
+# versiones desenrolladas para los tamaños de anillo más comunes en Wialon:
+# los vértices quedan en locales (fuera del ciclo de puntos) y sin saltos de índice
+_PIP_UNROLLED_SIZES = (4, 5, 6, 8, 12)
+
+
+def _pip_unrolled_source(n: int) -> str:
+    lines = [
+        f"def _points_in_polygon_n{n}(lats_p, lons_p, lons, lats):",
+        *[f"    x{i} = lons[{i}]; y{i} = lats[{i}]" for i in range(n)],
+        "    out = np.zeros(lats_p.shape[0], dtype=np.bool_)",
+        "    for k in range(lats_p.shape[0]):",
+        "        lat = lats_p[k]; lon = lons_p[k]",
+        "        inside = False",
+    ]
+    j = n - 1
+    for i in range(n):
+        # si las y's quedan a distinto lado de lat, yj - yi != 0
+        lines += [
+            f"        if (y{i} > lat) != (y{j} > lat):",
+            f"            if lon < (x{j} - x{i}) * (lat - y{i}) / (y{j} - y{i}) + x{i}:",
+            "                inside = not inside",
+        ]
+        j = i
+    lines += ["        out[k] = inside", "    return out"]
+    return "\n".join(lines)
+
+
+def _build_unrolled_pips() -> Dict[int, Any]:
+    # código generado: numba no puede cachearlo en disco, se compila en el warmup
+    kernels = {}
+    for n in _PIP_UNROLLED_SIZES:
+        ns: Dict[str, Any] = {"np": np}
+        exec(_pip_unrolled_source(n), ns)
+        kernels[n] = njit(fastmath=True)(ns[f"_points_in_polygon_n{n}"])
+    return kernels
+
+
+_PIP_SPECIALIZED: Dict[int, Any] = _build_unrolled_pips()
+
+
+def _warmup_kernels() -> None:
+    """Fuerza la compilación JIT al arrancar para no cobrarla al primer request."""
+    # mismos tipos que el cruce: anillos y unidades en float32
+    ring = np.ascontiguousarray([0.0, 1.0, 1.0, 0.0], dtype=np.float32)
+    _point_in_polygon(0.5, 0.5, ring, ring[::-1].copy())
+    _points_in_polygon(ring, ring, ring, ring[::-1].copy())
+    for n, kernel in _PIP_SPECIALIZED.items():
+        t = np.linspace(0.0, 2 * np.pi, n, endpoint=False, dtype=np.float32)
+        kernel(ring, ring, np.cos(t), np.sin(t))
@@ -1,32 +1,130 @@
 # wialon_geocercas.py
 # FastAPI para exponer unidades y geocercas de Wialon
-# versión ligera para Render: el cruce acepta resource_id y límite
+# para Render: el cruce acepta resource_id y límite; se precalcula en segundo
+# plano sobre todas las unidades con posición (max_units solo recorta la
+# respuesta, ya no acota el cómputo)
+#
+# arranque (Render): python wialon_geocercas.py
+#   equivale a: uvicorn wialon_geocercas:app --workers N --proxy-headers
+#   loop/http en "auto": usa uvloop y httptools (de uvicorn[standard]) si
+#   están instalados; en Windows uvloop no existe y cae a asyncio
+#   X-Forwarded-* solo se confía desde FORWARDED_ALLOW_IPS (variable de uvicorn)
 
 import os
 import time
-import json
-from typing import Optional, Dict, Any, List
-
-import requests
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+from typing import Optional, Dict, Any, List, Tuple
+
+import orjson
+from cachetools import TTLCache
+import numpy as np
+from scipy.spatial import cKDTree
+from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
-
-# ------------------------------------------------------------
-# .env (local) / variables de entorno (Render)
-# ------------------------------------------------------------
-load_dotenv()
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
+
+from wialon_core import (
+    wialon_call,
+    wialon_batch,
+    open_client,
+    close_client,
+    _prepare_zone,
+    _warmup_kernels,
+)
 
-WIALON_BASE = os.getenv("WIALON_BASE", "https://hst-api.wialon.com/wialon/ajax.html")
-WIALON_TOKEN = os.getenv("WIALON_TOKEN", "")
+# a partir de cuántos pares unidad×círculo se usa el KDTree
+KDTREE_MIN_PAIRS = 5000
+
+_EMPTY: Dict[str, Any] = {}
+
+# caches locales del proceso: geocercas por recurso (cambian cada minutos)
+# y unidades (las posiciones cambian seguido, TTL corto).
+# con varios workers cada uno tiene su propia cache (y su propio sid)
+_ZONE_CACHE: TTLCache = TTLCache(maxsize=256, ttl=120)
+_UNIT_CACHE: TTLCache = TTLCache(maxsize=1, ttl=10)
+_RESOURCE_CACHE: TTLCache = TTLCache(maxsize=1, ttl=120)
+
+# cruces precalculados por resource_id (None = todos los recursos), sobre
+# todas las unidades; max_units se aplica al responder. Cada entrada guarda
+# cuándo se pidieron sus unidades a Wialon (edad de los datos, no del cálculo).
+# El refresher solo recalcula los que se pidieron en el último minuto, y un
+# cruce con datos más viejos que CROSS_MAX_AGE_S (p. ej. porque el refresh
+# falla) se recalcula en línea, una sola vez por clave aunque lleguen varios.
+CROSS_REFRESH_S = 5
+CROSS_ACTIVE_S = 60
+CROSS_MAX_AGE_S = 2 * CROSS_REFRESH_S
+_cross_cache: Dict[Optional[int], Tuple[float, List[Dict[str, Any]]]] = {}
+_cross_active: Dict[Optional[int], float] = {}
+_cross_building: Dict[Optional[int], "asyncio.Task[List[Dict[str, Any]]]"] = {}
+
+log = logging.getLogger("wialon_geocercas")
+
+
+async def _refresh_crosses() -> None:
+    now = time.time()
+    for key, last in list(_cross_active.items()):
+        if now - last > CROSS_ACTIVE_S:
+            _cross_active.pop(key, None)
+            _cross_cache.pop(key, None)
+    keys = list(_cross_active)
+    if not keys:
+        return
+
+    # el refresher es el único que sondea: unidades nuevas una vez por ciclo,
+    # y los cruces las leen de la cache en vez de pedirlas cada uno
+    try:
+        await _fetch_units(fresh=True)
+    except Exception as e:
+        log.warning("refresh de unidades falló: %r", e)
+        for key in keys:
+            _cross_cache.pop(key, None)
+        return
+
+    # las claves que ya se están calculando en línea no se duplican
+    keys = [key for key in keys if key not in _cross_building]
+    results = await asyncio.gather(*[_build_cross(key) for key in keys], return_exceptions=True)
+    for key, built in zip(keys, results):
+        if isinstance(built, BaseException):
+            # sin cache: el siguiente request recalcula (o devuelve el error)
+            log.warning("refresh del cruce %s falló: %r", key, built)
+            _cross_cache.pop(key, None)
+        elif key in _cross_active:
+            _cross_cache[key] = built
+
+
+async def _cross_refresher() -> None:
+    while True:
+        await _refresh_crosses()
+        await asyncio.sleep(CROSS_REFRESH_S)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _warmup_kernels()
+    open_client()
+    refresher = asyncio.create_task(_cross_refresher())
+    try:
+        yield
+    finally:
+        refresher.cancel()
+        with suppress(asyncio.CancelledError):
+            await refresher
+        await close_client()
 
-SESSION_SID: Optional[str] = None
-SESSION_TS: float = 0
 
 # ------------------------------------------------------------
 # FastAPI
 # ------------------------------------------------------------
-app = FastAPI(title="Wialon Backend", version="1.1.0")
+# ORJSONResponse ya serializa con OPT_SERIALIZE_NUMPY
+app = FastAPI(
+    title="Wialon Backend",
+    version="1.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # CORS abierto para que Vercel pueda llamar
 app.add_middleware(
@@ -37,108 +135,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ------------------------------------------------------------
-# helpers de sesión
-# ------------------------------------------------------------
-def _login_with_token(token: str) -> str:
-    r = requests.get(
-        WIALON_BASE,
-        params={
-            "svc": "token/login",
-            "params": json.dumps({"token": token, "fl": 8}),
-        },
-        timeout=20,
-    )
-    if not r.ok:
-        raise HTTPException(status_code=502, detail=f"token/login HTTP {r.status_code}")
-    data = r.json()
-    sid = data.get("eid") or data.get("sid")
-    if not sid:
-        raise HTTPException(status_code=400, detail=f"token/login falló: {data}")
-    return sid
-
-
-def _ensure_sid() -> str:
-    global SESSION_SID, SESSION_TS
-    if not WIALON_TOKEN:
-        raise HTTPException(status_code=400, detail="Falta WIALON_TOKEN en entorno")
-
-    # usa cache 4 minutos
-    if SESSION_SID and (time.time() - SESSION_TS) < 240:
-        return SESSION_SID
-
-    try:
-        sid = _login_with_token(WIALON_TOKEN)
-        SESSION_SID = sid
-        SESSION_TS = time.time()
-        return sid
-    except HTTPException as e:
-        # si el token en realidad ya es un sid
-        if "WRONG_PARAMS" in str(e.detail) or "invalid token" in str(e.detail).lower():
-            SESSION_SID = WIALON_TOKEN
-            SESSION_TS = time.time()
-            return SESSION_SID
-        raise
-
-
-def wialon_call(svc: str, params: Dict[str, Any]) -> Any:
-    sid = _ensure_sid()
-    r = requests.get(
-        WIALON_BASE,
-        params={"svc": svc, "params": json.dumps(params), "sid": sid},
-        timeout=40,
-    )
-    if not r.ok:
-        raise HTTPException(status_code=502, detail=f"Wialon HTTP {r.status_code}: {r.text}")
-
-    data = r.json()
-    # errores de sesión → reintenta una vez
-    if isinstance(data, dict) and data.get("error") in (1, 2, 3, 4, 5, 8):
-        global SESSION_SID
-        SESSION_SID = None
-        sid = _ensure_sid()
-        r2 = requests.get(
-            WIALON_BASE,
-            params={"svc": svc, "params": json.dumps(params), "sid": sid},
-            timeout=40,
-        )
-        if not r2.ok:
-            raise HTTPException(status_code=502, detail=f"Wialon HTTP {r2.status_code}: {r2.text}")
-        return r2.json()
-    return data
-
-
-# ------------------------------------------------------------
-# utilidades de geometría
-# ------------------------------------------------------------
-def _point_in_polygon(lat: float, lon: float, ring: List[Dict[str, float]]) -> bool:
-    inside = False
-    n = len(ring)
-    if n < 3:
-        return False
-    for i in range(n):
-        j = (i - 1) % n
-        xi, yi = ring[i]["lon"], ring[i]["lat"]
-        xj, yj = ring[j]["lon"], ring[j]["lat"]
-        intersect = ((yi > lat) != (yj > lat)) and (
-            lon < (xj - xi) * (lat - yi) / ((yj - yi) or 1e-12) + xi
-        )
-        if intersect:
-            inside = not inside
-    return inside
-
-
-def _dist_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    dy = (lat2 - lat1) * 111_000
-    dx = (lon2 - lon1) * 111_000
-    return (dx * dx + dy * dy) ** 0.5
-
+# geocercas con muchos vértices → respuestas grandes y repetitivas
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # ------------------------------------------------------------
 # endpoints base
 # ------------------------------------------------------------
 @app.get("/")
-def root():
+async def root():
     return {
         "ok": True,
         "endpoints": [
@@ -152,49 +156,100 @@ def root():
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 
 # ------------------------------------------------------------
 # unidades / recursos
 # ------------------------------------------------------------
-@app.get("/wialon/units", summary="Lista de unidades")
-def list_units():
-    data = wialon_call(
-        "core/search_items",
-        {
-            "spec": {
-                "itemsType": "avl_unit",
-                "propName": "sys_name",
-                "propValueMask": "*",
-                "sortType": "sys_name",
-            },
-            "force": 1,
-            "flags": 1025,
-            "from": 0,
-            "to": 0,
-        },
+_UNITS_SEARCH: Dict[str, Any] = {
+    "spec": {
+        "itemsType": "avl_unit",
+        "propName": "sys_name",
+        "propValueMask": "*",
+        "sortType": "sys_name",
+    },
+    "force": 1,
+    "flags": 1025,
+    "from": 0,
+    "to": 0,
+}
+
+
+async def _fetch_units(fresh: bool = False) -> Dict[str, Any]:
+    if not fresh:
+        cached = _UNIT_CACHE.get("units")
+        if cached is not None:
+            return cached
+    fetched_at = time.time()
+    units = _units_from_search(await wialon_call("core/search_items", _UNITS_SEARCH))
+    units["fetched_at"] = fetched_at
+    _UNIT_CACHE["units"] = units
+    return units
+
+
+def _units_from_search(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Unidades como columnas NumPy (id/lat/lon/t/speed) + lista de nombres.
+
+    Sin posición: lat/lon = NaN y t/speed = -1; se vuelven None en la respuesta.
+    """
+    items = data.get("items", [])
+    n = len(items)
+    ids = np.empty(n, dtype=np.int64)
+    lats = np.empty(n, dtype=np.float64)
+    lons = np.empty(n, dtype=np.float64)
+    ts = np.empty(n, dtype=np.int64)
+    speeds = np.empty(n, dtype=np.int64)
+    names: List[Optional[str]] = [None] * n
+    for i, it in enumerate(items):
+        pos = it.get("pos") or _EMPTY
+        ids[i] = it["id"]
+        names[i] = it.get("nm")
+        y, x = pos.get("y"), pos.get("x")
+        lats[i] = np.nan if y is None else y
+        lons[i] = np.nan if x is None else x
+        ts[i] = pos.get("t", -1)
+        speeds[i] = pos.get("s", -1)
+
+    return {"id": ids, "name": names, "lat": lats, "lon": lons, "t": ts, "speed": speeds}
+
+
+def _units_to_json(units: Dict[str, Any]) -> List[Dict[str, Any]]:
+    cols = zip(
+        units["id"].tolist(),
+        units["name"],
+        units["lat"].tolist(),
+        units["lon"].tolist(),
+        units["t"].tolist(),
+        units["speed"].tolist(),
     )
-    out = []
-    for it in data.get("items", []):
-        pos = it.get("pos") or {}
-        out.append(
-            {
-                "id": it.get("id"),
-                "name": it.get("nm"),
-                "lat": pos.get("y"),
-                "lon": pos.get("x"),
-                "t": pos.get("t"),
-                "speed": pos.get("s"),
-            }
-        )
+    return [
+        {
+            "id": uid,
+            "name": name,
+            "lat": None if lat != lat else lat,
+            "lon": None if lon != lon else lon,
+            "t": None if t < 0 else t,
+            "speed": None if speed < 0 else speed,
+        }
+        for uid, name, lat, lon, t, speed in cols
+    ]
+
+
+@app.get("/wialon/units", summary="Lista de unidades")
+async def list_units(fresh: bool = Query(False, description="ignora la cache")):
+    out = _units_to_json(await _fetch_units(fresh))
     return {"count": len(out), "units": out}
 
 
-@app.get("/wialon/resources", summary="Lista de recursos")
-def list_resources():
-    data = wialon_call(
+async def _fetch_resources(fresh: bool = False) -> List[Dict[str, Any]]:
+    if not fresh:
+        cached = _RESOURCE_CACHE.get("resources")
+        if cached is not None:
+            return cached
+
+    data = await wialon_call(
         "core/search_items",
         {
             "spec": {
@@ -209,16 +264,55 @@ def list_resources():
             "to": 0,
         },
     )
-    items = data.get("items", [])
-    return {"count": len(items), "resources": [{"id": r["id"], "name": r["nm"]} for r in items]}
+    resources = [{"id": r["id"], "name": r["nm"]} for r in data.get("items", [])]
+    _RESOURCE_CACHE["resources"] = resources
+    return resources
+
+
+@app.get("/wialon/resources", summary="Lista de recursos")
+async def list_resources(fresh: bool = Query(False, description="ignora la cache")):
+    resources = await _fetch_resources(fresh)
+    return {"count": len(resources), "resources": resources}
 
 
 # ------------------------------------------------------------
 # geocercas por recurso
 # ------------------------------------------------------------
-@app.get("/wialon/resources/{resource_id}/geofences", summary="Geocercas del recurso")
-def geofences_of_resource(resource_id: int):
-    raw = wialon_call("resource/get_zone_data", {"itemId": resource_id, "flags": 0x1F})
+def _to_json_points(xy: Optional[np.ndarray]) -> Optional[List[Dict[str, float]]]:
+    if xy is None:
+        return None
+    return [{"lat": lat, "lon": lon} for lon, lat in xy.tolist()]
+
+
+def _zone_to_json(z: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": z["id"],
+        "name": z["name"],
+        "type": z["type"],
+        "color_argb": z["color_argb"],
+        "points": _to_json_points(z["points_xy"]),
+        "center": z["center"],
+        "radius": z["radius"],
+    }
+
+
+def _zone_data_params(resource_id: int) -> Dict[str, Any]:
+    return {"itemId": resource_id, "flags": 0x1F}
+
+
+async def _fetch_geofences(resource_id: int, fresh: bool = False) -> List[Dict[str, Any]]:
+    if not fresh:
+        cached = _ZONE_CACHE.get(resource_id)
+        if cached is not None:
+            return cached
+    raw = await wialon_call("resource/get_zone_data", _zone_data_params(resource_id))
+    zones = _zones_from_data(raw)
+    _ZONE_CACHE[resource_id] = zones
+    return zones
+
+
+def _zones_from_data(raw: Any) -> List[Dict[str, Any]]:
+    """Geocercas ya normalizadas y preparadas para el cruce."""
     iterable = raw.values() if isinstance(raw, dict) else (raw or [])
     zones = []
     for z in iterable:
@@ -229,24 +323,21 @@ def geofences_of_resource(resource_id: int):
             "name": name,
             "type": z.get("t"),
             "color_argb": z.get("c") or jp.get("color_argb"),
-            "points": None,
+            "points_xy": None,
             "center": None,
             "radius": None,
         }
 
-        # polígono
+        # polígono: arreglo (n, 2) de (lon, lat) en float64, tal cual llega de
+        # Wialon (la respuesta JSON sale de aquí); el cruce usa copias float32
         if jp.get("points"):
-            item["points"] = [
-                {"lat": float(p["lat"]), "lon": float(p["lon"])} for p in jp["points"]
-            ]
+            pts = [(p["lon"], p["lat"]) for p in jp["points"]]
         elif z.get("p"):
-            pts = []
-            for p in z["p"]:
-                if isinstance(p, dict):
-                    pts.append({"lat": float(p["y"]), "lon": float(p["x"])})
-                else:
-                    pts.append({"lat": float(p[1]), "lon": float(p[0])})
-            item["points"] = pts
+            pts = [(p["x"], p["y"]) if isinstance(p, dict) else (p[0], p[1]) for p in z["p"]]
+        else:
+            pts = None
+        if pts:
+            item["points_xy"] = np.asarray(pts, dtype=np.float64)
 
         # círculo
         if jp.get("center") and jp.get("radius"):
@@ -258,59 +349,236 @@ def geofences_of_resource(resource_id: int):
             item["center"] = {"lat": float(c["y"]), "lon": float(c["x"])}
             item["radius"] = float(z["r"])
 
-        zones.append(item)
+        zones.append(_prepare_zone(item))
+
+    return zones
+
+
+async def _fetch_units_and_geofences(
+    resource_id: int, fresh: bool = False, fresh_units: bool = False
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Unidades + geocercas de un recurso; lo que falte en cache va en un solo core/batch."""
+    units = None if fresh or fresh_units else _UNIT_CACHE.get("units")
+    zones = None if fresh else _ZONE_CACHE.get(resource_id)
+    if units is not None and zones is not None:
+        return units, zones
+    if units is not None:
+        return units, await _fetch_geofences(resource_id, fresh=True)
+    if zones is not None:
+        return await _fetch_units(fresh=True), zones
+
+    fetched_at = time.time()
+    units_raw, zones_raw = await wialon_batch(
+        [
+            ("core/search_items", _UNITS_SEARCH),
+            ("resource/get_zone_data", _zone_data_params(resource_id)),
+        ]
+    )
+    units, zones = _units_from_search(units_raw), _zones_from_data(zones_raw)
+    units["fetched_at"] = fetched_at
+    _UNIT_CACHE["units"] = units
+    _ZONE_CACHE[resource_id] = zones
+    return units, zones
+
 
-    return {"resource_id": resource_id, "count": len(zones), "geofences": zones}
+@app.get("/wialon/resources/{resource_id}/geofences", summary="Geocercas del recurso")
+async def geofences_of_resource(
+    resource_id: int,
+    fresh: bool = Query(False, description="ignora la cache"),
+):
+    zones = await _fetch_geofences(resource_id, fresh)
+    return {
+        "resource_id": resource_id,
+        "count": len(zones),
+        "geofences": [_zone_to_json(z) for z in zones],
+    }
 
 
 # ------------------------------------------------------------
 # cruce local (ligero)
 # ------------------------------------------------------------
+def _hits_to_csr(
+    resource_id: int,
+    unit_ids: np.ndarray,
+    unit_pos: np.ndarray,
+    hit_units: List[np.ndarray],
+    hit_zones: List[np.ndarray],
+) -> Dict[str, Any]:
+    """Pares (unidad, zona) → formato CSR por unidad.
+
+    Las zonas de unit_ids[i] son zone_ids[offsets[i]:offsets[i + 1]];
+    unit_pos[i] es su posición en la lista de unidades (ascendente).
+    """
+    if not hit_units:
+        empty = np.empty(0, dtype=np.int64)
+        return {
+            "resource_id": resource_id,
+            "unit_pos": empty,
+            "unit_ids": empty,
+            "zone_ids": empty,
+            "offsets": np.zeros(1, dtype=np.int64),
+        }
+    units = np.concatenate(hit_units)
+    zones = np.concatenate(hit_zones)
+    # orden estable: por unidad, respetando el orden de las zonas
+    order = np.argsort(units, kind="stable")
+    uniq, counts = np.unique(units[order], return_counts=True)
+    offsets = np.zeros(uniq.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        "resource_id": resource_id,
+        "unit_pos": unit_pos[uniq],
+        "unit_ids": unit_ids[uniq],
+        "zone_ids": zones[order],
+        "offsets": offsets,
+    }
+
+
+def _cross_json(blocks: List[Dict[str, Any]], max_units: int) -> bytes:
+    """Recorta cada bloque a las primeras max_units unidades y serializa."""
+    result = []
+    for b in blocks:
+        # unit_pos es ascendente: las unidades dentro del límite son un prefijo
+        cut = int(np.searchsorted(b["unit_pos"], max_units))
+        offsets = b["offsets"][: cut + 1]
+        result.append(
+            {
+                "resource_id": b["resource_id"],
+                "unit_ids": b["unit_ids"][:cut],
+                "zone_ids": b["zone_ids"][: offsets[-1]],
+                "offsets": offsets,
+            }
+        )
+    # orjson serializa los arreglos NumPy sin pasar por listas
+    return orjson.dumps({"ok": True, "result": result}, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
 @app.get(
     "/wialon/units/in-geofences/local",
     summary="Cruce local limitado (para Render)",
 )
-def cross_units_local(
+async def cross_units_local(
     resource_id: Optional[int] = Query(None, description="ID de recurso wialon (recomendado)"),
-    max_units: int = Query(200, description="máximo de unidades a considerar"),
+    max_units: int = Query(200, description="máximo de unidades a devolver"),
+    fresh: bool = Query(False, description="ignora la cache de unidades y geocercas"),
 ):
-    # 1) unidades
-    units_resp = list_units()
-    units = units_resp["units"][:max_units]
-
-    # 2) recursos
+    if fresh:
+        _, blocks = await _build_cross(resource_id, fresh=True)
+    else:
+        entry = _cross_cache.get(resource_id)
+        if entry is None or time.time() - entry[0] > CROSS_MAX_AGE_S:
+            # si falla, el error llega al cliente y la clave no queda activa
+            blocks = await _rebuild_cross_shared(resource_id)
+        else:
+            blocks = entry[1]
+        # activa: el refresher la mantiene al día en segundo plano
+        _cross_active[resource_id] = time.time()
+    return Response(_cross_json(blocks, max_units), media_type="application/json")
+
+
+async def _rebuild_cross(resource_id: Optional[int]) -> List[Dict[str, Any]]:
+    # unidades recién pedidas: con las de la cache (hasta 10 s) el cruce
+    # podría nacer ya vencido
+    built = await _build_cross(resource_id, fresh_units=True)
+    _cross_cache[resource_id] = built
+    return built[1]
+
+
+async def _rebuild_cross_shared(resource_id: Optional[int]) -> List[Dict[str, Any]]:
+    """Recalcula en línea; requests concurrentes de la misma clave esperan el mismo cálculo."""
+    task = _cross_building.get(resource_id)
+    if task is None:
+        task = asyncio.create_task(_rebuild_cross(resource_id))
+        _cross_building[resource_id] = task
+        task.add_done_callback(lambda _: _cross_building.pop(resource_id, None))
+    # shield: si un cliente se desconecta no cancela el cálculo de los demás
+    return await asyncio.shield(task)
+
+
+async def _build_cross(
+    resource_id: Optional[int], fresh: bool = False, fresh_units: bool = False
+) -> Tuple[float, List[Dict[str, Any]]]:
+    """Cruce de todas las unidades con posición × geocercas, en bloques CSR por recurso.
+
+    Devuelve (momento en que se pidieron las unidades, bloques).
+    """
+    # 1) unidades, recursos y geocercas en paralelo
     if resource_id is not None:
-      resources = [{"id": resource_id, "name": ""}]
+        resources = [{"id": resource_id, "name": ""}]
+        all_units, zones = await _fetch_units_and_geofences(resource_id, fresh, fresh_units)
+        zones_per_resource = [zones]
     else:
-      resources = list_resources()["resources"]
-
-    result: Dict[str, Dict[str, List[int]]] = {}
-
-    for r in resources:
-        rid = r["id"]
-        geos = geofences_of_resource(rid)["geofences"]
-        result[str(rid)] = {}
-
-        for u in units:
-            lat = u.get("lat")
-            lon = u.get("lon")
-            if lat is None or lon is None:
-                continue
-
-            hits: List[int] = []
-            for g in geos:
-                if g.get("points"):
-                    if _point_in_polygon(lat, lon, g["points"]):
-                        hits.append(int(g["id"]))
-                        continue
-                if g.get("center") and g.get("radius"):
-                    c = g["center"]
-                    d = _dist_m(lat, lon, c["lat"], c["lon"])
-                    if d <= float(g["radius"]):
-                        hits.append(int(g["id"]))
-                        continue
-
-            if hits:
-                result[str(rid)][str(u["id"])] = hits
-
-    return {"ok": True, "result": result}
+        all_units, resources = await asyncio.gather(
+            _fetch_units(fresh or fresh_units), _fetch_resources(fresh)
+        )
+        zones_per_resource = await asyncio.gather(
+            *[_fetch_geofences(r["id"], fresh) for r in resources]
+        )
+
+    # unidades con posición (las columnas ya vienen en NumPy)
+    lat, lon = all_units["lat"], all_units["lon"]
+    U_pos = np.nonzero(~(np.isnan(lat) | np.isnan(lon)))[0]
+    U_lat = lat[U_pos].astype(np.float32)
+    U_lon = lon[U_pos].astype(np.float32)
+    U_id = all_units["id"][U_pos]
+
+    # con muchas unidades × círculos conviene un índice espacial
+    n_circles = sum(1 for geos in zones_per_resource for g in geos if "_r2" in g)
+    tree = None
+    if U_id.size * n_circles > KDTREE_MIN_PAIRS:
+        tree = cKDTree(np.column_stack([U_lat * 111_000, U_lon * 111_000]).astype(np.float64))
+
+    result: List[Dict[str, Any]] = []
+
+    for r, geos in zip(resources, zones_per_resource):
+        hit_units: List[np.ndarray] = []
+        hit_zones: List[np.ndarray] = []
+
+        # una pasada por zona sobre todas las unidades
+        for g in geos:
+            inside = np.zeros(U_id.size, dtype=np.bool_)
+            if "_lons" in g:
+                bbox = g["_bbox"]
+                # descarte rápido por caja envolvente antes del PIP
+                cand = np.nonzero(
+                    (U_lat >= bbox[0]) & (U_lat <= bbox[1])
+                    & (U_lon >= bbox[2]) & (U_lon <= bbox[3])
+                )[0]
+                if cand.size:
+                    inside[cand] = g["_pip"](U_lat[cand], U_lon[cand], g["_lons"], g["_lats"])
+            if "_r2" in g:
+                c = g["center"]
+                if tree is not None:
+                    near = tree.query_ball_point(
+                        [c["lat"] * 111_000, c["lon"] * 111_000], g["radius"]
+                    )
+                    inside[near] = True
+                else:
+                    dy = (U_lat - c["lat"]) * 111_000
+                    dx = (U_lon - c["lon"]) * 111_000
+                    inside |= (dx * dx + dy * dy) <= g["_r2"]
+
+            k = np.nonzero(inside)[0]
+            if k.size:
+                hit_units.append(k)
+                hit_zones.append(np.full(k.size, int(g["id"]), dtype=np.int64))
+
+        result.append(_hits_to_csr(r["id"], U_id, U_pos, hit_units, hit_zones))
+
+    return all_units["fetched_at"], result
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "wialon_geocercas:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+        loop="auto",
+        http="auto",
+        # sin forwarded_allow_ips explícito: uvicorn lee FORWARDED_ALLOW_IPS
+        # (default 127.0.0.1); en Render se define con la IP/rango del proxy
+        proxy_headers=True,
+    )